@@ -7,7 +7,12 @@ basedir=$(dirname "$(readlink -f "$0")")
 # Make sure conda is updated to a version that supports the --no-capture-output option
 conda install -y -n base -c conda-forge "conda>=4.13.0"
 
-# Install dependencies from lock file for speed and reproducibility
+# Install dependencies from lock file for speed and reproducibility.  The lock
+# files are generated from environment/environment.yml (which pins the version of
+# every direct dependency) with conda-lock, so whenever environment.yml changes,
+# regenerate them like so:
+#
+#     conda-lock -f environment/environment.yml -p linux-64 -p osx-64 -k explicit
 case $(uname) in
 Linux)
     platform="linux"
@@ -21,7 +26,25 @@ Darwin)
     ;;
 esac
 
-conda create -y -n gedi_subset --file "${basedir}/environment/conda-${platform}-64.lock"
+lockfile="${basedir}/environment/conda-${platform}-64.lock"
+
+# Fail fast when the lock file does not provide every version pinned in
+# environment.yml (i.e., it was not regenerated after environment.yml changed)
+missing=$(
+    sed -n 's/^ *- *\([A-Za-z0-9_.-]*\)==\(.*\)$/\1-\2/p' \
+        "${basedir}/environment/environment.yml" |
+        while read -r pkg; do
+            grep -q "/${pkg}-" "${lockfile}" || echo "${pkg}"
+        done
+)
+
+if [[ -n "${missing}" ]]; then
+    echo >&2 "${lockfile} is out of date; it lacks:" ${missing}
+    echo >&2 "Regenerate the lock files with conda-lock (see above)."
+    exit 1
+fi
+
+conda create -y -n gedi_subset --file "${lockfile}"
 
 # Install maap-py, since it cannot be specified in the lock file
 conda env update -n gedi_subset --file "${basedir}/environment/environment-maappy.yml"
@@ -38,10 +61,14 @@ conda run --no-capture-output -n gedi_subset pip install -e "${basedir}"
 # have to wait to execute a DPS job to find out.
 conda run --no-capture-output -n gedi_subset python -c '
 import geopandas as gpd
+import shapely
 import tempfile
 import warnings
 from shapely.geometry import Point
 
+# Make sure shapely provides the 2.x vectorized API
+assert shapely.__version__.startswith("2."), shapely.__version__
+
 # Make sure pip install worked
 from maap.maap import MAAP
 
@@ -53,4 +80,15 @@ gdf = gpd.GeoDataFrame(d, crs="EPSG:4326")
 with tempfile.TemporaryFile() as fp:
     gdf.to_parquet(fp)
     assert gdf.equals(gpd.read_parquet(fp))
+
+# Make sure pyogrio (used for writing all vector output) is installed and works
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = f"{tmpdir}/test.gpkg"
+    gdf.to_file(path, driver="GPKG", engine="pyogrio")
+    assert gdf.equals(gpd.read_file(path, engine="pyogrio"))
+
+# Make sure pandas evaluates queries (--query) with numexpr
+from pandas.core.computation.check import NUMEXPR_INSTALLED
+
+assert NUMEXPR_INSTALLED, "numexpr is not installed"
 '
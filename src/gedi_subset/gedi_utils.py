@@ -1,37 +1,48 @@
-import json
+import copy
+import functools
+import io
 import logging
 import os
 import os.path
-import warnings
-from typing import Any, Callable, Mapping, Optional, Sequence, Union
-
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
+
+import geopandas as gpd
 import h5py
 import numpy as np
+import orjson
 import pandas as pd
 import requests
+import shapely
 from maap.Result import Granule
+from requests.adapters import HTTPAdapter
 from returns.curry import curry
+from returns.functions import raise_exception
 from returns.io import IOResultE, impure_safe
-from shapely.geometry import Polygon
 from shapely.geometry.base import BaseGeometry
 
 import gedi_subset.fp as fp
 from gedi_subset.h5frame import H5DataFrame
 
-# Suppress UserWarning: The Shapely GEOS version (3.10.2-CAPI-1.16.0) is incompatible
-# with the GEOS version PyGEOS was compiled with (3.8.1-CAPI-1.13.3). Conversions
-# between both will be slow.
-#  shapely_geos_version, geos_capi_version_string
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import geopandas as gpd
-
-
 logger = logging.getLogger(f"gedi_subset.{__name__}")
 
 
 def pprint(value: Any) -> None:
-    print(json.dumps(value, indent=2))
+    option = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    print(orjson.dumps(value, option=option).decode())
 
 
 # str -> str -> str
@@ -50,7 +61,9 @@ def gdf_to_file(
     mode = props.get("mode")
     props = dict(props, mode="w") if mode == "a" and not os.path.exists(file) else props
 
-    return impure_safe(gdf.to_file)(file, **props)
+    # Unless otherwise specified, write via pyogrio, which writes features in bulk
+    # through GDAL, rather than via fiona, which writes them one at a time.
+    return impure_safe(gdf.to_file)(file, **{"engine": "pyogrio", **props})
 
 
 @curry
@@ -61,68 +74,193 @@ def gdf_to_parquet(
     return impure_safe(gdf.to_parquet)(path)
 
 
-def gdf_read_parquet(path: Union[str, os.PathLike[str]]) -> IOResultE[gpd.GeoDataFrame]:
-    """Read a Parquet object from a file path and return it as a GeoDataFrame."""
-    return impure_safe(gpd.read_parquet)(path)
+def get_geo_boundary(iso: str, level: int) -> gpd.GeoDataFrame:
+    """Return the geoBoundaries boundary for a country (ISO code) and admin level.
 
+    The boundary is downloaded only once, and cached on disk in FlatGeobuf format,
+    which is much faster to read than GeoJSON.  Further, the most recently requested
+    boundary is cached in memory, so repeated calls with the same arguments return a
+    copy of the cached boundary.
+    """
+    return _get_geo_boundary(iso, level).copy()
 
-def get_geo_boundary(iso: str, level: int) -> gpd.GeoDataFrame:
-    file_path = f"/projects/my-public-bucket/iso3/{iso}-ADM{level}.json"
+
+@functools.lru_cache(maxsize=1)
+def _http_session() -> requests.Session:
+    """Return a (shared) HTTP session, which keeps connections alive across
+    requests to the same host, rather than establishing a new connection for
+    every request."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _get_geo_boundary(iso: str, level: int) -> gpd.GeoDataFrame:
+    file_path = f"/projects/my-public-bucket/iso3/{iso}-ADM{level}.fgb"
 
     if not os.path.exists(file_path):
-        r = requests.get(
-            "https://www.geoboundaries.org/gbRequest.html",
-            dict(ISO=iso, ADM=f"ADM{level}"),
-        )
-        r.raise_for_status()
-        dl_url = r.json()[0]["gjDownloadURL"]
-        geo_boundary = requests.get(dl_url).json()
+        _download_geo_boundary(iso, level, file_path)
 
-        with open(file_path, "w") as out:
-            out.write(json.dumps(geo_boundary))
+    # Read the cached file even upon a cache miss, so the result is always the same
+    return gpd.read_file(file_path, engine="pyogrio")
 
-    return gpd.read_file(file_path)
+
+def _download_geo_boundary(iso: str, level: int, file_path: str) -> None:
+    session = _http_session()
+    r = session.get(
+        "https://www.geoboundaries.org/gbRequest.html",
+        params=dict(ISO=iso, ADM=f"ADM{level}"),
+    )
+    r.raise_for_status()
+    dl_url = orjson.loads(r.content)[0]["gjDownloadURL"]
+    r = session.get(dl_url)
+    r.raise_for_status()
+
+    gdf = gpd.read_file(io.BytesIO(r.content), engine="pyogrio")
+    # Without a spatial index, FlatGeobuf keeps the features in their given order
+    gdf.to_file(file_path, driver="FlatGeobuf", engine="pyogrio", SPATIAL_INDEX="NO")
+
+
+def _granule_polygons(granules: Sequence[Granule]) -> np.ndarray:
+    """Return an array of the polygons determined by the points in the granules'
+    horizontal spatial domains."""
+    boundaries = [
+        granule["Granule"]["Spatial"]["HorizontalSpatialDomain"]["Geometry"][
+            "GPolygon"
+        ]["Boundary"]["Point"]
+        for granule in granules
+    ]
+    coords = np.array(
+        [
+            [point["PointLongitude"], point["PointLatitude"]]
+            for points in boundaries
+            for point in points
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    indices = np.repeat(np.arange(len(boundaries)), [len(ps) for ps in boundaries])
+
+    return shapely.polygons(shapely.linearrings(coords, indices=indices))
 
 
 @curry
-def granule_intersects(aoi: BaseGeometry, granule: Granule):
+def granule_intersects(aoi: BaseGeometry, granule: Granule) -> bool:
     """Determines whether or not a granule intersects an Area of Interest
 
     Returns `True` if the polygon determined by the points in the `granule`'s
     horizontal spatial domain intersects the geometry of the Area of Interest;
-    `False` otherwise.
+    `False` otherwise.  The AOI geometry is not modified (in particular, not
+    prepared).
     """
-    points = granule["Granule"]["Spatial"]["HorizontalSpatialDomain"]["Geometry"][
-        "GPolygon"
-    ]["Boundary"]["Point"]
-    polygon = Polygon(
-        [[float(p["PointLongitude"]), float(p["PointLatitude"])] for p in points]
+    return bool(shapely.intersects(_granule_polygons([granule])[0], aoi))
+
+
+def granules_intersecting_aoi(
+    granules: Iterable[Granule], aoi: BaseGeometry
+) -> List[Granule]:
+    """Return the granules that intersect an Area of Interest, in their given
+    order."""
+    granules = list(granules)
+    tree = shapely.STRtree(_granule_polygons(granules))
+    hits = np.sort(tree.query(aoi, predicate="intersects"))
+
+    return [granules[i] for i in hits]
+
+
+# Minimum number of coordinates of an AOI geometry for which `make_aoi_grid` builds
+# a grid, and the number of grid cells along each axis
+AOI_GRID_MIN_COORDINATES = 1_000
+AOI_GRID_SIZE = 128
+
+
+@dataclass(frozen=True)
+class AOIGrid:
+    """Grid over the bounding box of an AOI, indicating which cells (by row and
+    column) lie entirely inside of the AOI, and which lie entirely outside of it."""
+
+    bounds: Tuple[float, float, float, float]
+    inside: np.ndarray
+    outside: np.ndarray
+
+
+def make_aoi_grid(aoi: BaseGeometry) -> Optional[AOIGrid]:
+    """Return a grid over a complex AOI, for use with `spatial_filter`, or `None`
+    for an AOI simple enough to test points against directly."""
+    if shapely.get_num_coordinates(aoi) < AOI_GRID_MIN_COORDINATES or aoi.area == 0:
+        return None
+
+    minx, miny, maxx, maxy = aoi.bounds
+    xs = np.linspace(minx, maxx, AOI_GRID_SIZE + 1)
+    ys = np.linspace(miny, maxy, AOI_GRID_SIZE + 1)
+    x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+    x1, y1 = np.meshgrid(xs[1:], ys[1:])
+    cells = shapely.box(x0, y0, x1, y1)
+
+    return AOIGrid(
+        aoi.bounds,
+        shapely.contains_properly(aoi, cells),
+        shapely.disjoint(aoi, cells),
     )
 
-    return polygon.intersects(aoi)
 
+def _intersects_xy(
+    aoi: BaseGeometry, aoi_grid: Optional[AOIGrid], x: np.ndarray, y: np.ndarray
+) -> np.ndarray:
+    """Same as ``shapely.intersects_xy``, but resolving points by lookup in the
+    AOI's grid, when given one.  Points must lie within the AOI's bounding box."""
+    if aoi_grid is None:
+        return shapely.intersects_xy(aoi, x, y)
 
-def spatial_filter(beam, aoi):
-    """
-    Find the record indices within the aoi
-    TODO: Make this faster
-    """
-    lat = beam["lat_lowestmode"][:]
-    lon = beam["lon_lowestmode"][:]
-    i = np.arange(0, len(lat), 1)  # index
-    geo_arr = list(zip(lat, lon, i))
-    l4adf = pd.DataFrame(geo_arr, columns=["lat_lowestmode", "lon_lowestmode", "i"])
-    l4agdf = gpd.GeoDataFrame(
-        l4adf, geometry=gpd.points_from_xy(l4adf.lon_lowestmode, l4adf.lat_lowestmode)
+    minx, miny, maxx, maxy = aoi_grid.bounds
+    last = AOI_GRID_SIZE - 1
+    col = np.clip(
+        ((x - minx) * (AOI_GRID_SIZE / (maxx - minx))).astype(np.intp), 0, last
+    )
+    row = np.clip(
+        ((y - miny) * (AOI_GRID_SIZE / (maxy - miny))).astype(np.intp), 0, last
     )
-    l4agdf.crs = "EPSG:4326"
-    # TODO: is it faster with a spatial index, or rough pass with BBOX first?
-    bbox = aoi.geometry[0].bounds
-    l4agdf_clip = l4agdf.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
-    l4agdf_gsrm = l4agdf_clip[l4agdf_clip["geometry"].within(aoi.geometry[0])]
-    indices = l4agdf_gsrm.i
 
-    return indices
+    result = aoi_grid.inside[row, col]
+    edge = ~(result | aoi_grid.outside[row, col])
+    result[edge] = shapely.intersects_xy(aoi, x[edge], y[edge])
+
+    return result
+
+
+def spatial_filter(
+    beam: h5py.Group,
+    aoi: BaseGeometry,
+    lat: str = "lat_lowestmode",
+    lon: str = "lon_lowestmode",
+    aoi_grid: Optional[AOIGrid] = None,
+) -> np.ndarray:
+    """Return the sorted indices of the points of a BEAM group (given by its `lat`
+    and `lon` datasets) that fall within (or on the boundary of) an AOI."""
+    lat_ds, lon_ds = beam[lat], beam[lon]
+
+    # h5py cannot read directly into an empty buffer
+    if lat_ds.size == 0:
+        return np.empty(0, dtype=np.intp)
+
+    lats = np.empty(lat_ds.shape, dtype=np.float64)
+    lons = np.empty(lon_ds.shape, dtype=np.float64)
+    lat_ds.read_direct(lats)
+    lon_ds.read_direct(lons)
+
+    minx, miny, maxx, maxy = aoi.bounds
+    mask = lons >= minx
+    mask &= lons <= maxx
+    mask &= lats >= miny
+    mask &= lats <= maxy
+
+    if mask.any():
+        mask[mask] = _intersects_xy(aoi, aoi_grid, lons[mask], lats[mask])
+
+    return np.flatnonzero(mask)
 
 
 def is_coverage_beam(beam: h5py.Group) -> bool:
@@ -134,8 +272,11 @@ def is_power_beam(beam: h5py.Group) -> bool:
 
 
 def beam_filter_from_names(names: Sequence[str]):
+    upper_names = tuple(name.upper() for name in names)
+
     def is_named_beam(beam: h5py.Group) -> bool:
-        return any(name.upper() in beam.name.upper() for name in names)
+        beam_name = beam.name.upper()
+        return any(name in beam_name for name in upper_names)
 
     return is_named_beam
 
@@ -143,12 +284,14 @@ def beam_filter_from_names(names: Sequence[str]):
 def subset_hdf5(
     hdf5: h5py.Group,
     *,
-    aoi: gpd.GeoDataFrame,
+    aoi: Union[gpd.GeoDataFrame, BaseGeometry],
     lat: str,
     lon: str,
     beam_filter: Callable[[h5py.Group], bool] = fp.always(True),
     columns: Sequence[str],
     query: Optional[str],
+    max_workers: int = 1,
+    aoi_grid: Optional[AOIGrid] = None,
 ) -> gpd.GeoDataFrame:
     """Subset the data in an HDF5 Group into a ``geopandas.GeoDataFrame``.
 
@@ -216,7 +359,7 @@ def subset_hdf5(
     ----------
     hdf5 : h5py.Group
         HDF5 group to subset (typically an ``h5py.File`` instance).
-    aoi : gpd.GeoDataFrame
+    aoi : Union[gpd.GeoDataFrame, BaseGeometry]
         Area of Interest.  The subset is limited to data points that fall within this
         area of interest, as determined by the latitude and longitude datasets of each
         `"BEAM*"` group within the HDF5 file.
@@ -245,6 +388,12 @@ def subset_hdf5(
         of the `"BEAM*"` groups of the HDF5 file into rows across with columns formed by
         the groups' datasets, only rows satisfying this query expression are returned.
         If not specified, _all_ rows are returned.
+    max_workers : int = 1
+        Maximum number of `"BEAM*"` groups to subset concurrently, each in a separate
+        thread.
+    aoi_grid : Optional[AOIGrid] = None
+        Grid over the AOI, as returned by py:`make_aoi_grid`.  If not supplied, it is
+        built from the AOI.
 
     Returns
     -------
@@ -252,10 +401,10 @@ def subset_hdf5(
         GeoDataFrame containing the subset of the data from the HDF5 group/file that
         fall within the specified area of interest and satisfy the specified query.
         Columns are limited to the specified sequence of column names, along with
-        `filename` (str) and `BEAM` (str) columns. Further, the query is applied to, and
-        the columns are selected from, only the top-level subgroups that have names
-        prefixed with ``"BEAM"`` and for which the ``beam_filter`` function returns
-        ``True``.
+        `filename` and `BEAM` (categorical str) columns. Further, the query is
+        applied to, and the columns are selected from, only the top-level subgroups that
+        have names prefixed with ``"BEAM"`` and for which the ``beam_filter`` function
+        returns ``True``.
 
     Examples
     --------
@@ -364,39 +513,96 @@ def subset_hdf5(
     `"BEAM*"` groups.
     """
 
-    def subset_beam(beam: h5py.Group) -> gpd.GeoDataFrame:
-        """Subset an individual `"BEAM*"` group as described above."""
-        df: pd.DataFrame = H5DataFrame(beam)
-        # Keep only the rows matching the specified query
+    def subset_beam(beam: h5py.Group) -> Tuple[str, Dict[str, np.ndarray]]:
+        """Subset an individual `"BEAM*"` group as described above, returning the
+        BEAM name (without the `"BEAM"` prefix), along with the subset's data for the
+        specified columns and the coordinates, by name."""
+        # Read data only for the points within the area of interest
+        rows = spatial_filter(beam, aoi_geom, lat, lon, grid)
+        df: pd.DataFrame = H5DataFrame(beam, rows=rows)
+        # Keep only the rows matching the specified query (even when there are no
+        # rows, so that an invalid query always fails)
         if query:
             df.query(query, inplace=True)
-        # Grab the coordinates for the geometry, before dropping columns
-        geometry = gpd.points_from_xy(df[lon], df[lat])
-        # Drop all columns NOT specified by the columns parameter
-        df = df[list(columns)]
-        df.insert(0, "BEAM", beam.name[5:])
-        gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
 
-        # Clip subset to the area of interest
-        return gpd.clip(gdf, aoi.set_crs(epsg=4326))
+        return beam.name[5:], {name: df[name].to_numpy() for name in names}
+
+    # Drop duplicate column names (preserving order)
+    columns = list(dict.fromkeys(columns))
+    names = dict.fromkeys((*columns, lon, lat))
 
+    # Prepare (a copy of) the AOI geometry once, for all BEAM groups
+    if isinstance(aoi, BaseGeometry):
+        aoi_geom = aoi if shapely.is_prepared(aoi) else copy.copy(aoi)
+    else:
+        aoi_geom = aoi.unary_union
+    shapely.prepare(aoi_geom)
+    grid = make_aoi_grid(aoi_geom) if aoi_grid is None else aoi_grid
+    filename = os.path.basename(hdf5.file.filename)
+
+    # Avoid opening non-BEAM groups (e.g., ANCILLARY and METADATA)
     beams = (
         group
-        for name, group in hdf5.items()
-        if name.startswith("BEAM") and beam_filter(group)
+        for name in hdf5
+        if name.startswith("BEAM") and beam_filter(group := hdf5[name])
     )
-    beams_gdf = pd.concat(map(subset_beam, beams), ignore_index=True, copy=False)
-    beams_gdf.insert(0, "filename", os.path.basename(hdf5.file.filename))
 
-    return beams_gdf
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers) as executor:
+            subsets = list(executor.map(subset_beam, beams))
+    else:
+        subsets = list(map(subset_beam, beams))
+
+    # No BEAM group passed the filter
+    if not subsets:
+        return gpd.GeoDataFrame(
+            columns=["filename", "BEAM", *columns], geometry=[], crs="EPSG:4326"
+        )
+
+    # Concatenate the BEAM groups' subsets column by column into a single
+    # GeoDataFrame
+    beam_names, beam_data = zip(*subsets)
+
+    def concat(name: str) -> np.ndarray:
+        return np.concatenate([data[name] for data in beam_data])
+
+    points = shapely.points(concat(lon), concat(lat))
+
+    sizes = [len(data[lon]) for data in beam_data]
+    # Encode the filename and BEAM names as categories, rather than repeating a
+    # string per row
+    filename_codes = np.zeros(sum(sizes), dtype=np.int8)
+    beam_codes = np.repeat(np.arange(len(beam_names), dtype=np.int8), sizes)
+    column_data: Dict[str, Any] = {
+        "filename": pd.Categorical.from_codes(
+            cast(Sequence[int], filename_codes), categories=pd.Index([filename])
+        ),
+        "BEAM": pd.Categorical.from_codes(
+            cast(Sequence[int], beam_codes), categories=pd.Index(beam_names)
+        ),
+        **{name: concat(name) for name in columns},
+    }
+
+    return gpd.GeoDataFrame(
+        column_data,
+        geometry=gpd.array.from_shapely(points, crs="EPSG:4326"),
+        copy=False,
+    )
 
 
-def write_subset(infile, gdf):
+def write_subset(infile, gdf, *, output_format="fgb"):
     """
-    Write GeoDataFrame to Flatgeobuf
-    TODO: What's the most efficient format?
+    Write GeoDataFrame to FlatGeobuf, or to GeoParquet (zstd-compressed) when
+    `output_format` is ``"parquet"``, alongside the HDF5 file from which it was
+    subsetted.  Return the path of the written file.
     """
-    outfile = infile.replace(".h5", ".fgb")
-    gdf.to_file(outfile, driver="FlatGeobuf")
+    if output_format == "parquet":
+        outfile = infile.replace(".h5", ".parquet")
+        gdf.to_parquet(outfile, compression="zstd", index=False)
+    elif output_format == "fgb":
+        outfile = infile.replace(".h5", ".fgb")
+        gdf_to_file(outfile, dict(driver="FlatGeobuf"), gdf).alt(raise_exception)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format!r}")
 
     return outfile
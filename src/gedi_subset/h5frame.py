@@ -4,9 +4,48 @@ import re
 from typing import Any, Iterable, Literal, cast, overload
 
 import h5py
+import numpy as np
 import pandas as pd
 
-import gedi_subset.fp as fp
+
+def read_rows(
+    dataset: h5py.Dataset, rows: np.ndarray | None, *index: int
+) -> np.ndarray:
+    """Read the specified rows (all rows, if `None`) of an HDF5 dataset.
+
+    Rather than using h5py "fancy indexing," which performs very poorly for more
+    than a handful of indices, only the contiguous block of rows spanning the first
+    through the last of the specified (sorted, unique) row indices is read from the
+    dataset, and the rows are then selected from the block in memory (unless the rows
+    are themselves contiguous, in which case the block is returned as is, avoiding a
+    second copy).  Any additional indices are applied to the remaining dimensions of
+    the dataset (e.g., the index of a column of a 2D dataset).
+
+    Further, when the dataset is chunked, and the rows fall within separate runs of
+    chunks (e.g., where a beam crosses the AOI more than once), each run is read
+    separately, to avoid reading (and decompressing) the chunks between runs, which
+    contain none of the rows.
+    """
+    if rows is None:
+        return dataset[(slice(None), *index)]
+    if rows.size == 0:
+        return dataset[(slice(0, 0), *index)]
+
+    if dataset.chunks and len(runs := _chunk_runs(rows, dataset.chunks[0])) > 1:
+        return np.concatenate([read_rows(dataset, run, *index) for run in runs])
+
+    start, stop = int(rows[0]), int(rows[-1]) + 1
+    block = dataset[(slice(start, stop), *index)]
+
+    return block if stop - start == rows.size else block[rows - start]
+
+
+def _chunk_runs(rows: np.ndarray, chunk_size: int) -> list[np.ndarray]:
+    """Split (sorted, unique) row indices into runs of rows falling within
+    consecutive chunks of `chunk_size` rows."""
+    chunks = rows // chunk_size
+    # Split wherever one or more chunks are skipped between consecutive rows
+    return np.split(rows, np.flatnonzero(np.diff(chunks) > 1) + 1)
 
 
 class H5DataFrame(pd.DataFrame):
@@ -18,6 +57,11 @@ class H5DataFrame(pd.DataFrame):
         HDF5 group to use as the backing store for this DataFrame.  This may be
         either an open h5py.File or an h5py.Group, which is the superclass of
         h5py.File.
+    rows: numpy.ndarray, optional
+        Sorted, unique indices of the rows to read from the datasets within the group.
+        If not supplied, all rows are read.  Specifying only the rows of interest
+        (for example, only points within an area of interest) avoids reading
+        and querying data that would otherwise be discarded.
 
     Examples
     --------
@@ -153,9 +197,15 @@ class H5DataFrame(pd.DataFrame):
     ...
     """
 
-    _metadata = ["_group", "_parent"]
+    _metadata = ["_group", "_parent", "_rows", "_members"]
 
-    def __init__(self, group: h5py.Group, parent: "H5DataFrame" | None = None) -> None:
+    def __init__(
+        self,
+        group: h5py.Group,
+        parent: "H5DataFrame" | None = None,
+        *,
+        rows: np.ndarray | None = None,
+    ) -> None:
         super().__init__()
 
         if not isinstance(group, h5py.Group):
@@ -165,6 +215,8 @@ class H5DataFrame(pd.DataFrame):
 
         self._group = group
         self._parent = parent
+        self._rows = rows
+        self._members: dict[str, h5py.Dataset | h5py.Group | None] = {}
 
     def __contains__(self, key) -> bool:
         # Since we don't add columns to self during initialization, we must
@@ -187,7 +239,8 @@ class H5DataFrame(pd.DataFrame):
             # The key is possibly a "collection" of keys, so attempt to get the
             # column for each one, to make sure each has been read from our
             # backing h5py.Group and added as a column to self.
-            fp.for_each(self.__getitem__)(key)
+            for k in key:
+                self[k]
 
         result = super().__getitem__(key)
 
@@ -211,16 +264,66 @@ class H5DataFrame(pd.DataFrame):
             # fetch `rh` and select column 50 from it, inserting the result as a column
             # named `rh50` into self.
             name, index = match.groups()
+            value = self.__get_member(name)
+
+            if isinstance(value, h5py.Dataset) and value.ndim == 2:
+                # Read only the selected column from the backing store, rather than
+                # reading the entire 2D dataset only to discard all other columns.
+                return self.__wrap_item(key_, value, int(index))
+
             return self.__wrap_item(key_, self[name][int(index)])
 
         return super().__getitem__(key_)
 
-    def __wrap_item(self, key: str, value: h5py.Dataset | h5py.Group):
+    def __get_member(self, name: str) -> h5py.Dataset | h5py.Group | None:
+        # Keep a reference to every member fetched by name, so that it remains open
+        # for the lifetime of self.  In particular, this retains the HDF5 chunk cache
+        # of a 2D dataset across reads of several of its columns (e.g., `rh50` and
+        # `rh98`), rather than decompressing the same chunks again for each column.
+        if name not in self._members:
+            self._members[name] = self.group.get(name)
+
+        return self._members[name]
+
+    def __selected_rows(self) -> tuple[np.ndarray | None, pd.Index | None]:
+        # Return the indices of the rows to read from the backing datasets, along
+        # with the index to give the data read (or `None` for a default index).
+        #
+        # Once columns have been inserted into the root, some rows might have been
+        # discarded (e.g., by a query), in which case only the remaining rows are
+        # read, such that the data read is already aligned with the existing columns.
+        # This avoids reading (and copying) data only to discard it by reindexing.
+        root = self.root
+        index = root.index
+
+        if root.columns.empty or (
+            isinstance(index, pd.RangeIndex)
+            and not index.empty
+            # Compare ranges (cheaply), rather than the index values
+            and index.equals(pd.RangeIndex(len(index)))
+        ):
+            # No rows have been discarded
+            return self.rows, None
+        if not (
+            pd.api.types.is_integer_dtype(index)
+            and index.is_monotonic_increasing
+            and index.is_unique
+        ):
+            # The index no longer corresponds to row positions, so rely on alignment
+            return self.rows, None
+
+        positions = index.to_numpy()
+
+        return (positions if self.rows is None else self.rows[positions]), index
+
+    def __wrap_item(
+        self, key: str, value: h5py.Dataset | h5py.Group | np.ndarray, *index: int
+    ):
         if isinstance(value, h5py.Group):
             return H5DataFrame(value, self)
-        if value.ndim == 2:
-            return pd.DataFrame(value)
-        if value.ndim != 1:
+        if value.ndim - len(index) == 2:
+            return pd.DataFrame(read_rows(value, self.rows))
+        if value.ndim - len(index) != 1:
             return super().__getitem__(key)
 
         # If self has no rows (empty index), but has at least 1 column, we want our new
@@ -231,8 +334,17 @@ class H5DataFrame(pd.DataFrame):
         # previously empty columns with NaN values.
 
         name = f"{self.relpath}/{key}".lstrip("/")
-        data = [] if self.index.empty and not self.columns.empty else value
-        column = pd.Series(data, dtype=value.dtype)
+
+        if isinstance(value, h5py.Dataset):
+            rows, row_index = self.__selected_rows()
+            data = read_rows(value, rows, *index)
+        else:
+            data, row_index = value, None
+
+        if row_index is None and self.index.empty and not self.columns.empty:
+            data = data[:0]
+
+        column = pd.Series(data, index=row_index, dtype=value.dtype, copy=False)
         self.root.insert(len(self.root.columns), name, column)
 
         return self.root[name]
@@ -241,6 +353,8 @@ class H5DataFrame(pd.DataFrame):
         df.__class__ = H5DataFrame
         df._group = self._group
         df._parent = self._parent
+        df._rows = self._rows
+        df._members = self._members
 
         return cast(H5DataFrame, df)
 
@@ -256,6 +370,12 @@ class H5DataFrame(pd.DataFrame):
     def parent(self) -> H5DataFrame | None:
         return self._parent
 
+    @property
+    def rows(self) -> np.ndarray | None:
+        """Sorted, unique indices of the rows read from the backing datasets (all
+        rows, if `None`), which are always those of the root H5DataFrame."""
+        return self._rows if self.parent is None else self.parent.rows
+
     @property
     def relpath(self) -> str:
         path = self.root.group.name
@@ -279,6 +399,6 @@ class H5DataFrame(pd.DataFrame):
         # Insert self as a resolver since the built-in columns resolver won't resolve
         # columns that have not yet been loaded from the backing store.
         kwargs["resolvers"] = (self, *tuple(kwargs.get("resolvers", ())))
-        result = super().query(expr, inplace, **kwargs)  # type: ignore
+        result = super().query(expr, inplace=inplace, **kwargs)  # type: ignore
 
         return self.__narrow(result) if isinstance(result, pd.DataFrame) else result
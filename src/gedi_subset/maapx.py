@@ -11,25 +11,30 @@ Granule functions:
 
 import logging
 import operator
-from typing import TYPE_CHECKING, Mapping, Union
+import os.path
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
 
 import boto3
-from cachetools import FIFOCache, cached
-from cachetools.func import ttl_cache
+import botocore.session
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from botocore.exceptions import ClientError, NoCredentialsError
 from maap.maap import MAAP
 from maap.Result import Collection, Granule
-from returns.converters import result_to_maybe
 from returns.curry import partial
-from returns.io import IOResult, IOResultE, impure_safe
-from returns.maybe import Maybe
-from returns.pipeline import flow, is_successful, pipe
-from returns.pointfree import bind, bind_result, lash, map_
+from returns.io import IOFailure, IOResultE, impure_safe
+from returns.maybe import Maybe, Nothing
+from returns.pipeline import flow, pipe
+from returns.pointfree import bind_result, lash
 from returns.result import Failure, safe
 
 from gedi_subset import fp
 
 if TYPE_CHECKING:
-    from maap.AWS import AWSCredentials
+    from mypy_boto3_s3.client import S3Client
 
 logger = logging.getLogger(f"gedi_subset.{__name__}")
 
@@ -43,38 +48,144 @@ def _is_s3_credentials_online_resource(resource) -> bool:
 
 
 def _s3_credentials_endpoint(granule: Granule) -> Maybe[str]:
-    return flow(
-        granule.get("Granule", {}).get("OnlineResources", {}).get("OnlineResource", []),
-        lambda resources: resources if isinstance(resources, list) else [resources],
-        fp.find(_is_s3_credentials_online_resource),
-        bind(safe(operator.itemgetter("URL"))),
-        result_to_maybe,
+    resources = (
+        granule.get("Granule", {}).get("OnlineResources", {}).get("OnlineResource", [])
     )
 
+    # Scan the resources directly, since this is called for every granule
+    # downloaded, and the equivalent flow of curried combinators and containers
+    # costs far more than the scan itself.
+    for resource in resources if isinstance(resources, list) else [resources]:
+        if _is_s3_credentials_online_resource(resource):
+            return Maybe.from_optional(resource.get("URL"))
+
+    return Nothing
+
+
+# Region of Earthdata Cloud S3 buckets, used unless a region is configured (e.g.,
+# via the AWS_DEFAULT_REGION environment variable).
+EARTHDATA_S3_DEFAULT_REGION = "us-west-2"
+
+# Earthdata S3 credentials expire after 1 hour, so refresh them a bit sooner.
+_EARTHDATA_S3_CREDENTIALS_TTL = timedelta(minutes=55)
 
-@ttl_cache(ttl=55 * 60)
-def _earthdata_s3_credentials(maap: MAAP, endpoint: str) -> IOResultE["AWSCredentials"]:
-    """Returns short-term AWS credentials obtained from an S3 credentials endpoint."""
+
+def _earthdata_s3_credentials_metadata(maap: MAAP, endpoint: str) -> Dict[str, str]:
+    """Returns short-term AWS credentials obtained from an S3 credentials endpoint,
+    in the form of metadata required by botocore's `RefreshableCredentials`.
+    """
 
     logger.debug(f"Obtaining S3 credentials from {endpoint}")
 
-    return impure_safe(maap.aws.earthdata_s3_credentials)(endpoint)
+    creds = maap.aws.earthdata_s3_credentials(endpoint)
+    expiry_time = datetime.now(timezone.utc) + _EARTHDATA_S3_CREDENTIALS_TTL
+
+    return {
+        "access_key": creds["accessKeyId"],
+        "secret_key": creds["secretAccessKey"],
+        "token": creds["sessionToken"],
+        "expiry_time": expiry_time.isoformat(),
+    }
+
+
+class _EarthdataS3CredentialProvider(CredentialProvider):
+    """Provides credentials obtained from an S3 credentials endpoint, which botocore
+    automatically refreshes before they expire.
+    """
+
+    METHOD = "custom-earthdata-s3"
+    CANONICAL_NAME = "custom-earthdata-s3"
+
+    def __init__(self, maap: MAAP, endpoint: str):
+        super().__init__()
+        self.maap = maap
+        self.endpoint = endpoint
+
+    def load(self) -> RefreshableCredentials:
+        return RefreshableCredentials.create_from_metadata(
+            metadata=_earthdata_s3_credentials_metadata(self.maap, self.endpoint),
+            refresh_using=partial(
+                _earthdata_s3_credentials_metadata, self.maap, self.endpoint
+            ),
+            method=self.METHOD,
+        )
+
+
+@lru_cache(maxsize=8)
+def _s3_client(maap: MAAP, endpoint: Optional[str]) -> "S3Client":
+    """Returns an S3 client using credentials obtained from an S3 credentials
+    endpoint, which botocore automatically refreshes before they expire, so the
+    client never needs to be created again for the same endpoint.  Without an
+    endpoint, the client uses botocore's default chain of credential providers.
+    """
 
+    logger.debug(f"Creating S3 client for {endpoint or 'default credentials'}")
 
-@cached(cache=FIFOCache(maxsize=1), key=lambda creds: creds["sessionToken"])
-def _setup_default_boto3_session(creds: "AWSCredentials") -> None:
-    """Sets up the default boto3 session using the specified credentials."""
+    # Use a dedicated session, rather than (re)configuring, or even using, the
+    # default session, which is not safe to share across threads.
+    botocore_session = botocore.session.Session()
 
-    logger.debug("Setting up default boto3 session with new credentials")
+    if endpoint is not None:
+        botocore_session.get_component("credential_provider").insert_before(
+            "env", _EarthdataS3CredentialProvider(maap, endpoint)
+        )
 
-    boto3.setup_default_session(
-        aws_access_key_id=creds["accessKeyId"],
-        aws_secret_access_key=creds["secretAccessKey"],
-        aws_session_token=creds["sessionToken"],
-        # TODO: make this configurable
-        region_name="us-west-2",
+    region_name = (
+        botocore_session.get_config_variable("region") or EARTHDATA_S3_DEFAULT_REGION
     )
 
+    return boto3.session.Session(
+        botocore_session=botocore_session, region_name=region_name
+    ).client("s3")
+
+
+# Granules are downloaded concurrently, in threads, all of which typically start by
+# using the same S3 credentials endpoint.  The cache does not hold its own lock
+# while computing a missing value, so without this lock, every thread would create
+# its own client (and request its own credentials), rather than only the first.
+# Once created, a client is safe to share across threads.
+_s3_client_lock = threading.Lock()
+
+
+@impure_safe
+def _use_s3_client(maap: MAAP, endpoint: Optional[str]) -> "S3Client":
+    with _s3_client_lock:
+        return _s3_client(maap, endpoint)
+
+
+@impure_safe
+def _download_s3(s3: "S3Client", todir: str, url: str) -> str:
+    parsed_url = urlparse(url)
+    dest = os.path.join(todir, os.path.basename(parsed_url.path))
+
+    if not os.path.exists(dest):
+        s3.download_file(parsed_url.netloc, parsed_url.path.lstrip("/"), dest)
+
+    return dest
+
+
+# Granule.getData first attempts to download via S3 with boto3's default session,
+# which is not safe to use across threads, so it is called by one thread at a time.
+_get_data_lock = threading.Lock()
+
+
+@impure_safe
+def _get_data(granule: Granule, todir: str) -> str:
+    with _get_data_lock:
+        return granule.getData(todir)
+
+
+def _download_granule_data(
+    granule: Granule, todir: str, error: Exception
+) -> IOResultE[str]:
+    if not isinstance(error, (ClientError, NoCredentialsError)):
+        return IOFailure(error)
+
+    granule_ur = granule["Granule"]["GranuleUR"]
+    logger.debug(f"Failed to download granule {granule_ur} from S3 [{error}]")
+
+    return _get_data(granule, todir)
+
 
 def download_granule(maap: MAAP, todir: str, granule: Granule) -> IOResultE[str]:
     """Download a granule's data file.
@@ -91,22 +202,34 @@ def download_granule(maap: MAAP, todir: str, granule: Granule) -> IOResultE[str]
     logger.debug(f"Downloading granule {granule_ur} to directory {todir}")
 
     if download_url and download_url.startswith("s3"):
-        result: Union[Maybe, IOResultE] = flow(
-            _s3_credentials_endpoint(granule),
-            bind(partial(_earthdata_s3_credentials, maap)),
-            map_(_setup_default_boto3_session),
+        # Download the granule with a shared S3 client, using credentials obtained
+        # from the granule's S3 credentials endpoint, if it has one.  If the attempt
+        # to obtain S3 credentials is unsuccessful, return the failure rather than
+        # proceeding to download the granule.  If the S3 download fails (e.g., S3
+        # direct access works only from within us-west-2), fall back to
+        # Granule.getData, which downloads the granule via HTTPS when it cannot do
+        # so via S3.
+        endpoint = _s3_credentials_endpoint(granule).value_or(None)
+        s3_url: str = download_url
+
+        return _use_s3_client(maap, endpoint).bind(
+            lambda s3: _download_s3(s3, todir, s3_url).lash(
+                partial(_download_granule_data, granule, todir)
+            )
         )
 
-        # If result is an IOResult, that means the granule has an S3 credentials
-        # endpoint, and an attempt was made to obtain S3 credentials.  If the
-        # attempt was unsuccessful, return the failure rather than proceeding to
-        # download the granule.
-        if isinstance(result, IOResult) and not is_successful(result):
-            return result
-
     return impure_safe(granule.getData)(todir)
 
 
+@lru_cache(maxsize=16)
+def _search_collection(
+    maap: MAAP, cmr_host: str, params: Tuple[Tuple[str, str], ...]
+) -> Tuple[Collection, ...]:
+    # Cache (successful) searches, since a given search always finds the same
+    # collection, so repeated searches need not repeat the CMR request.
+    return tuple(maap.searchCollection(cmr_host=cmr_host, limit=1, **dict(params)))
+
+
 def find_collection(
     maap: MAAP,
     cmr_host: str,
@@ -121,7 +244,7 @@ def find_collection(
     not_found_error = ValueError(f"No collection found at {cmr_host}: {params}")
 
     return flow(
-        impure_safe(maap.searchCollection)(cmr_host=cmr_host, limit=1, **params),
+        impure_safe(_search_collection)(maap, cmr_host, tuple(sorted(params.items()))),
         bind_result(
             pipe(
                 safe(operator.itemgetter(0)),
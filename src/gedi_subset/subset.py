@@ -1,40 +1,64 @@
 #!/usr/bin/env -S python -W ignore::FutureWarning -W ignore::UserWarning
 
+import copy
 import logging
 import multiprocessing
 import os
 import os.path
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing
 from dataclasses import dataclass
 from enum import Enum
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import Pool
 from pathlib import Path
-from typing import Any, Callable, Iterable, Mapping, NoReturn, Optional, Sequence, Tuple
+from typing import (
+    Any,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NoReturn,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import geopandas as gpd
 import h5py
+import orjson
+import pyarrow
+import pyarrow.parquet as pq
+import pyogrio.raw
+import shapely
 import typer
 from maap.maap import MAAP
 from maap.Result import Collection, Granule
-from returns.curry import partial
-from returns.functions import raise_exception, tap
+from returns.functions import identity, raise_exception
 from returns.io import IOFailure, IOResult, IOResultE, IOSuccess, impure_safe
-from returns.iterables import Fold
 from returns.maybe import Maybe, Nothing, Some
-from returns.pipeline import flow, is_successful, pipe
-from returns.pointfree import bind, bind_ioresult, bind_result, lash, map_
+from returns.pipeline import flow
+from returns.pointfree import bind_result
 from returns.result import Failure, Success
 from returns.unsafe import unsafe_perform_io
+from shapely.geometry.base import BaseGeometry
 
 import gedi_subset.fp as fp
 from gedi_subset import osx
 from gedi_subset.gedi_utils import (
+    AOIGrid,
     beam_filter_from_names,
     chext,
-    gdf_read_parquet,
-    gdf_to_file,
     gdf_to_parquet,
-    granule_intersects,
+    granules_intersecting_aoi,
     is_coverage_beam,
     is_power_beam,
+    make_aoi_grid,
     subset_hdf5,
 )
 from gedi_subset.maapx import download_granule, find_collection
@@ -48,6 +72,23 @@ class CMRHost(str, Enum):
         return self.value
 
 
+class OutputFormat(str, Enum):
+    gpkg = "gpkg"
+    fgb = "fgb"
+    parquet = "parquet"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+# OGR drivers for writing output files, by output file extension.  Output files
+# with any other extension are written as GeoParquet, directly via pyarrow.
+OGR_DRIVERS = {".gpkg": "GPKG", ".fgb": "FlatGeobuf"}
+
+
+# Number of rows per row group of combined GeoParquet output
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
+
 logical_dois = {
     "L1B": "10.5067/GEDI/GEDI01_B.002",
     "L2A": "10.5067/GEDI/GEDI02_A.002",
@@ -57,31 +98,37 @@ logical_dois = {
 
 DEFAULT_LIMIT = 10_000
 
+# Size of the HDF5 chunk cache of each dataset read from a granule file (the HDF5
+# default of 1 MiB is too small to hold the chunks of a BEAM's 2D datasets)
+HDF5_CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+
 LOGGING_FORMAT = "%(asctime)s [%(processName)s:%(name)s] [%(levelname)s] %(message)s"
 
 logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
 logger = logging.getLogger("gedi_subset")
+# pyogrio logs (at INFO level) the number of records written by every write
+logging.getLogger("pyogrio").setLevel(logging.WARNING)
 
 
 @dataclass
 class SubsetGranuleProps:
-    """Properties for calling `subset_granule` with a single argument.
+    """Properties for subsetting a granule, packaged as a single argument.
 
-    Since `multiprocessing.Pool.imap_unordered` does not support supplying
-    multiple iterators (like `builtins.map` does) for producing muliple
-    arguments to the supplied function, we must package all "arguments" into a
-    single argument.
+    Within a pool process, the properties of each granule are constructed by the
+    `make_props` callable given to `init_process`, so that only the granule (and
+    the result of downloading it) is sent to the process for each granule.
     """
 
     granule: Granule
     maap: MAAP
-    aoi_gdf: gpd.GeoDataFrame
+    aoi: Union[gpd.GeoDataFrame, BaseGeometry]
     lat: str
     lon: str
     beams: str
     columns: Sequence[str]
     query: Optional[str]
     output_dir: Path
+    aoi_grid: Optional[AOIGrid] = None
 
 
 def is_gedi_collection(c: Collection) -> bool:
@@ -150,13 +197,22 @@ def check_beams_option(value: str) -> str | NoReturn:
     )
 
 
-@impure_safe
-def subset_granule(props: SubsetGranuleProps) -> Maybe[str]:
+def aoi_geometry(aoi_gdf: gpd.GeoDataFrame) -> BaseGeometry:
+    """Return the union of the geometries of an AOI in lon/lat (EPSG:4326)
+    coordinates, assuming lon/lat coordinates when the AOI has no CRS."""
+
+    if aoi_gdf.crs is None:
+        aoi_gdf = aoi_gdf.set_crs(epsg=4326)
+
+    return aoi_gdf.to_crs(epsg=4326).unary_union
+
+
+def subset_granule(props: SubsetGranuleProps) -> IOResultE[Maybe[str]]:
     """Subset a granule to a GeoParquet file and return the output path.
 
     Download the specified granule (`props.granule`) obtained from a CMR search
     to the specified directory (`props.output_dir`), subset it to a GeoParquet
-    file where it overlaps with the specified AOI (`props.aoi_gdf`), remove the
+    file where it overlaps with the specified AOI (`props.aoi`), remove the
     downloaded granule file, and return the path to the output file.
 
     Return `Nothing` if the subset is empty or if an error occurred attempting
@@ -165,14 +221,39 @@ def subset_granule(props: SubsetGranuleProps) -> Maybe[str]:
     written; otherwise return `Some[str]` indicating the output path of the
     GeoParquet file.
     """
+    return subset_downloaded_granule(props, _download_granule(props))
+
 
-    io_result = download_granule(props.maap, str(props.output_dir), props.granule)
-    inpath = unsafe_perform_io(io_result.alt(raise_exception).unwrap())
+def _download_granule(props: SubsetGranuleProps) -> IOResultE[str]:
+    return impure_safe(download_granule)(
+        props.maap, str(props.output_dir), props.granule
+    ).bind(identity)
+
+
+@impure_safe
+def subset_downloaded_granule(
+    props: SubsetGranuleProps, download: IOResultE[str]
+) -> Maybe[str]:
+    """Subset a downloaded granule to a GeoParquet file and return the output path.
+
+    Same as `subset_granule`, but given the result of downloading the granule
+    (the path of the downloaded file), rather than downloading it, such that
+    downloads may be performed separately (e.g., concurrently, in threads).  If
+    the download failed, return the failure.
+    """
+    inpath = unsafe_perform_io(download.alt(raise_exception).unwrap())
 
     logger.debug(f"Subsetting {inpath}")
 
     try:
-        hdf5 = h5py.File(inpath)
+        # Each granule file is read by a single process, so skip file locking
+        hdf5 = h5py.File(
+            inpath,
+            "r",
+            locking=False,
+            rdcc_nbytes=HDF5_CHUNK_CACHE_BYTES,
+            rdcc_nslots=10_007,
+        )
     except Exception as e:
         granule_ur = props.granule["Granule"]["GranuleUR"]
         logger.warning(f"Skipping granule {granule_ur} [failed to read {inpath}: {e}]")
@@ -181,12 +262,13 @@ def subset_granule(props: SubsetGranuleProps) -> Maybe[str]:
     try:
         gdf = subset_hdf5(
             hdf5,
-            aoi=props.aoi_gdf,
+            aoi=props.aoi,
             lat=props.lat,
             lon=props.lon,
             beam_filter=beam_filter(props.beams),
             columns=props.columns,
             query=props.query,
+            aoi_grid=props.aoi_grid,
         )
     finally:
         hdf5.close()
@@ -204,8 +286,25 @@ def subset_granule(props: SubsetGranuleProps) -> Maybe[str]:
     return Some(outpath)
 
 
-def init_process(logging_level: int) -> None:
+# Constructs the properties for subsetting a granule within a pool process (set by
+# `init_process`, so the AOI is not pickled along with every granule)
+_make_props: Optional[Callable[[Granule], SubsetGranuleProps]] = None
+
+
+def init_process(
+    logging_level: int,
+    make_props: Optional[Callable[[Granule], SubsetGranuleProps]] = None,
+) -> None:
+    global _make_props
     set_logging_level(logging_level)
+    _make_props = make_props
+
+
+def _subset_downloaded_granule_in_process(
+    granule: Granule, download: IOResultE[str]
+) -> IOResultE[Maybe[str]]:
+    assert _make_props is not None, "process not initialized with make_props"
+    return subset_downloaded_granule(_make_props(granule), download)
 
 
 def set_logging_level(logging_level: int) -> None:
@@ -213,9 +312,30 @@ def set_logging_level(logging_level: int) -> None:
     logger.setLevel(logging_level)
 
 
+def _available_cpu_count() -> int:
+    """Return the number of CPUs the current process may run on.
+
+    This may be fewer than the number of CPUs on the host (as returned by
+    `os.cpu_count`), such as when running in a container restricted to a subset
+    of the host's CPUs.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def _remove_download(
+    future: "Future[Tuple[SubsetGranuleProps, IOResultE[str]]]",
+) -> None:
+    if not future.cancelled() and future.exception() is None:
+        _, download = future.result()
+        download.bind(osx.remove)
+
+
 def subset_granules(
     maap: MAAP,
-    aoi_gdf: gpd.GeoDataFrame,
+    aoi: BaseGeometry,
     lat: str,
     lon: str,
     beams: str,
@@ -224,46 +344,162 @@ def subset_granules(
     output_dir: Path,
     dest: Path,
     init_args: Tuple[Any, ...],
-    granules: Iterable[Granule],
+    granules: Sequence[Granule],
 ) -> IOResultE[Tuple[str, ...]]:
-    def subset_saved(path: IOResultE[Maybe[str]]) -> bool:
-        """Return `True` if `path`'s value is a `Some`, otherwise `False` if it
-        is `Nothing`.  This indicates whether or not a subset file was written
-        (and thus whether or not the subset was empty).
-        """
-        return unsafe_perform_io(map_(is_successful)(path).unwrap())
-
-    def append_subset(src: str) -> IOResultE[str]:
-        to_file_props = dict(index=False, mode="a", driver="GPKG")
-        logger.debug(f"Appending {src} to {dest}")
-
-        return flow(
-            gdf_read_parquet(src),
-            bind_ioresult(partial(gdf_to_file, dest, to_file_props)),
-            tap(pipe(fp.always(src), osx.remove)),
-            map_(fp.always(src)),
+    def read_subsets(
+        srcs: Sequence[str], schema: pyarrow.Schema
+    ) -> Iterator[pyarrow.Table]:
+        # Read the subsets in tables of (at least) PARQUET_ROW_GROUP_SIZE rows,
+        # removing each subset file once it is consumed
+        batches: List[pyarrow.RecordBatch] = []
+
+        for src in srcs:
+            with open(src, "rb") as f:
+                for batch in pq.ParquetFile(f).iter_batches(PARQUET_ROW_GROUP_SIZE):
+                    batches.append(batch)
+
+                    if sum(map(len, batches)) >= PARQUET_ROW_GROUP_SIZE:
+                        yield pyarrow.Table.from_batches(batches, schema)
+                        batches.clear()
+
+            osx.remove(src)
+
+        if batches:
+            yield pyarrow.Table.from_batches(batches, schema)
+
+    def write_subsets(srcs: Sequence[str]) -> None:
+        logger.debug(f"Writing {len(srcs)} subsets to {dest}")
+        # Pass the GeoParquet geometries along as WKB, as read
+        schema = pq.read_schema(srcs[0])
+        geo = orjson.loads(schema.metadata[b"geo"])
+        geometry_name = geo["primary_column"]
+        geometry_meta = geo["columns"][geometry_name]
+        # The (optional) bbox in the metadata is that of the first subset only
+        geometry_meta.pop("bbox", None)
+        schema = schema.with_metadata({**schema.metadata, b"geo": orjson.dumps(geo)})
+        tables = read_subsets(srcs, schema)
+
+        if (driver := OGR_DRIVERS.get(dest.suffix)) is None:
+            with pq.ParquetWriter(dest, schema, compression="zstd") as writer:
+                for table in tables:
+                    writer.write_table(table)
+        else:
+            fields = [name for name in schema.names if name != geometry_name]
+            append = os.path.exists(dest)
+
+            for table in tables:
+                pyogrio.raw.write(
+                    dest,
+                    table.column(geometry_name).to_numpy(),
+                    [table.column(name).to_numpy() for name in fields],
+                    fields,
+                    driver=driver,
+                    geometry_type=geometry_meta["geometry_types"][0],
+                    crs=orjson.dumps(geometry_meta["crs"]).decode(),
+                    append=append,
+                )
+                append = True
+
+    @impure_safe
+    def write_all(results: Iterable[IOResultE[Maybe[str]]]) -> Tuple[str, ...]:
+        subsets = []
+
+        for result in results:
+            # Fail fast (if subsetting errored out)
+            subset = unsafe_perform_io(result.alt(raise_exception).unwrap())
+            # Skip granules that produced empty subsets
+            if (src := subset.value_or(None)) is not None:
+                subsets.append(src)
+
+        if subsets:
+            write_subsets(subsets)
+
+        return tuple(subsets)
+
+    def subset(pool: Pool, props: SubsetGranuleProps, download: IOResultE[str]):
+        future: "Future[IOResultE[Maybe[str]]]" = Future()
+        pool.apply_async(
+            _subset_downloaded_granule_in_process,
+            (props.granule, download),
+            callback=future.set_result,
+            error_callback=future.set_exception,
         )
 
-    # https://docs.python.org/3/library/multiprocessing.html#multiprocessing.pool.Pool.imap
-    chunksize = 10
-    processes = os.cpu_count()
-    payloads = (
-        SubsetGranuleProps(
-            granule, maap, aoi_gdf, lat, lon, beams, columns, query, output_dir
-        )
-        for granule in granules
+        return future
+
+    def subset_all(pool: Pool) -> Generator[IOResultE[Maybe[str]], None, None]:
+        # Download granules in threads, and subset them in the pool of processes as
+        # downloads complete, with at most `max_pending` granules downloading or
+        # awaiting subsetting at any time (to bound disk usage)
+        downloads: Set["Future[Tuple[SubsetGranuleProps, IOResultE[str]]]"] = set()
+        subsets: Set["Future[IOResultE[Maybe[str]]]"] = set()
+
+        # Not a context manager, which would wait for downloads upon failure
+        downloader = ThreadPoolExecutor(download_workers)
+
+        try:
+            while True:
+                for props in islice(
+                    payloads, max_pending - len(downloads) - len(subsets)
+                ):
+                    downloads.add(
+                        downloader.submit(lambda p: (p, _download_granule(p)), props)
+                    )
+
+                if not downloads and not subsets:
+                    break
+
+                pending: Set["Future[Any]"] = downloads | subsets
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done & downloads:
+                    downloads.remove(future)
+                    subsets.add(subset(pool, *future.result()))
+
+                for future in done & subsets:
+                    subsets.remove(future)
+                    yield future.result()
+        finally:
+            # Cancel pending downloads, and remove the files of downloads in
+            # progress (upon failure) once they complete
+            downloader.shutdown(wait=False, cancel_futures=True)
+
+            for future in downloads:
+                future.add_done_callback(_remove_download)
+
+    # Don't start more processes than there are granules to subset
+    processes = max(1, min(_available_cpu_count(), len(granules)))
+    download_workers = processes
+    max_pending = 2 * processes
+    # Prepare (a copy of) the AOI only once, for the pool's (forked) processes
+    aoi = copy.copy(aoi)
+    shapely.prepare(aoi)
+    make_props = partial(
+        SubsetGranuleProps,
+        maap=maap,
+        aoi=aoi,
+        # Build the grid over a complex AOI only once per run, too
+        aoi_grid=make_aoi_grid(aoi),
+        lat=lat,
+        lon=lon,
+        beams=beams,
+        columns=columns,
+        query=query,
+        output_dir=output_dir,
     )
+    payloads = map(make_props, granules)
 
-    logger.info(f"Subsetting on {processes} processes (chunksize={chunksize})")
+    logger.info(
+        f"Subsetting on {processes} processes"
+        f" (downloading on {download_workers} threads)"
+    )
 
-    with multiprocessing.Pool(processes, init_process, init_args) as pool:
-        return flow(
-            pool.imap_unordered(subset_granule, payloads, chunksize),
-            fp.map(lash(raise_exception)),  # Fail fast (if subsetting errored out)
-            fp.filter(subset_saved),  # Skip granules that produced empty subsets
-            fp.map(bind(bind(append_subset))),  # Append non-empty subset
-            partial(Fold.collect, acc=IOSuccess(())),
-        )
+    # Create the pool (forking processes) before starting any download threads
+    with multiprocessing.Pool(
+        processes, init_process, (*init_args, make_props)
+    ) as pool, closing(subset_all(pool)) as results:
+        # Close the results upon failure, to promptly cancel pending downloads
+        return write_all(results)
 
 
 def main(
@@ -330,13 +566,22 @@ def main(
         readable=True,
         resolve_path=True,
     ),
+    output_format: OutputFormat = typer.Option(
+        OutputFormat.gpkg,
+        "--format",
+        help=(
+            "Format of the combined subset file: GeoPackage (gpkg), FlatGeobuf"
+            " (fgb), or GeoParquet (parquet), the latter two of which are much"
+            " faster to write for large subsets"
+        ),
+    ),
     verbose: bool = typer.Option(False, help="Provide verbose output"),
 ) -> None:
     logging_level = logging.DEBUG if verbose else logging.INFO
     set_logging_level(logging_level)
 
     os.makedirs(output_dir, exist_ok=True)
-    dest = output_dir / "gedi_subset.gpkg"
+    dest = output_dir / f"gedi_subset.{output_format}"
 
     # Remove existing combined subset file, primarily to support
     # testing.  When running in the context of a DPS job, there
@@ -348,7 +593,8 @@ def main(
 
     IOResult.do(
         subsets
-        for aoi_gdf in impure_safe(gpd.read_file)(aoi)
+        # Union the AOI only once, for both filtering and subsetting granules
+        for aoi_geom in impure_safe(gpd.read_file)(aoi).map(aoi_geometry)
         # Use wildcards around DOI value because some collections have incorrect
         # DOI values. For example, the L2B collection has the full DOI URL as
         # the DOI value (i.e., https://doi.org/<DOI> rather than just <DOI>).
@@ -356,12 +602,12 @@ def main(
         for granules in impure_safe(maap.searchGranule)(
             cmr_host=cmr_host,
             collection_concept_id=collection["concept-id"],
-            bounding_box=",".join(fp.map(str)(aoi_gdf.total_bounds)),
+            bounding_box=",".join(fp.map(str)(aoi_geom.bounds)),
             limit=limit,
         )
         for subsets in subset_granules(
             maap,
-            aoi_gdf,
+            aoi_geom,
             lat,
             lon,
             beams,
@@ -370,7 +616,7 @@ def main(
             output_dir,
             dest,
             (logging_level,),
-            fp.filter(partial(granule_intersects, aoi_gdf.geometry[0]))(granules),
+            granules_intersecting_aoi(granules, aoi_geom),
         )
     ).bind_ioresult(
         lambda subsets: IOSuccess(subsets)
@@ -1,12 +1,13 @@
 import os
 import warnings
-from typing import Iterable
+from typing import Any, Iterable, Mapping
 
 import boto3
 import h5py
 import pytest
 from maap.AWS import AWS
 from maap.maap import MAAP
+from maap.Result import Granule
 from moto import mock_s3
 from mypy_boto3_s3.client import S3Client
 
@@ -15,6 +16,16 @@ with warnings.catch_warnings():
     import geopandas as gpd
 
 
+def make_granule(metadata: Mapping[str, Any]) -> Granule:
+    return Granule(
+        metadata,
+        awsAccessKey="",
+        awsAccessSecret="",
+        apiHeader={},
+        cmrFileUrl="",
+    )
+
+
 class MockMAAP(MAAP):
     """Mock MAAP class to avoid the need for a maap.cfg file for testing."""
 
@@ -71,7 +82,8 @@ def aoi_gdf() -> gpd.GeoDataFrame:
     )
 
 
-@pytest.fixture(scope="session")
+# Function scope, since subsetting a granule removes the granule file
+@pytest.fixture(scope="function")
 def h5_path(tmp_path_factory: pytest.TempPathFactory) -> str:
     path = tmp_path_factory.mktemp("data") / "temp.h5"
 
@@ -1,13 +1,26 @@
 import os.path
 import warnings
-from typing import Optional, Set
+from typing import Any, Optional, Set, Tuple
 
 import h5py
+import numpy as np
 import pytest
+import shapely
+from maap.Result import Granule
 
-from gedi_subset.gedi_utils import subset_hdf5
+from gedi_subset.gedi_utils import (
+    AOI_GRID_MIN_COORDINATES,
+    granule_intersects,
+    granules_intersecting_aoi,
+    make_aoi_grid,
+    spatial_filter,
+    subset_hdf5,
+    write_subset,
+)
 from gedi_subset.subset import beam_filter
 
+from .conftest import make_granule
+
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     import geopandas as gpd
@@ -17,6 +30,94 @@ def fixture_path(filename: str) -> str:
     return os.path.join(os.path.dirname(__file__), "fixtures", filename)
 
 
+def granule(ur: str, *coords: Tuple[float, float]) -> Granule:
+    points = [{"PointLongitude": lon, "PointLatitude": lat} for lon, lat in coords]
+    polygon = {"GPolygon": {"Boundary": {"Point": points}}}
+
+    return make_granule(
+        {
+            "Granule": {
+                "GranuleUR": ur,
+                "OnlineAccessURLs": {
+                    "OnlineAccessURL": {"URL": f"s3://mybucket/{ur}.h5"}
+                },
+                "Spatial": {"HorizontalSpatialDomain": {"Geometry": polygon}},
+            }
+        }
+    )
+
+
+def test_granules_intersecting_aoi(aoi_gdf: gpd.GeoDataFrame) -> None:
+    aoi = aoi_gdf.unary_union
+    (minx, miny, maxx, maxy) = aoi.bounds
+    granules = [
+        # Overlaps the AOI
+        granule("a", (minx, miny), (maxx, miny), (maxx, maxy), (minx, miny)),
+        # Entirely east of the AOI
+        granule("b", (maxx + 1, miny), (maxx + 2, miny), (maxx + 2, maxy)),
+        # Entirely contains the AOI
+        granule("c", (minx - 1, miny - 1), (maxx + 1, miny - 1), (minx, maxy + 1)),
+    ]
+
+    intersecting = granules_intersecting_aoi(granules, aoi)
+
+    assert [g["Granule"]["GranuleUR"] for g in intersecting] == ["a", "c"]
+    assert intersecting == [g for g in granules if granule_intersects(aoi, g)]
+
+
+def test_granule_intersects_does_not_prepare_aoi(aoi_gdf: gpd.GeoDataFrame) -> None:
+    aoi = aoi_gdf.unary_union
+    (minx, miny, maxx, maxy) = aoi.bounds
+
+    assert granule_intersects(
+        aoi, granule("a", (minx, miny), (maxx, maxy), (minx, maxy))
+    )
+    assert not shapely.is_prepared(aoi)
+
+
+def test_granules_intersecting_aoi_no_granules(aoi_gdf: gpd.GeoDataFrame) -> None:
+    assert granules_intersecting_aoi([], aoi_gdf.unary_union) == []
+
+
+def test_spatial_filter(h5_path: str, aoi_gdf: gpd.GeoDataFrame) -> None:
+    with h5py.File(h5_path) as hdf5:
+        indices = spatial_filter(hdf5["BEAM0000"], aoi_gdf.unary_union)
+
+    np.testing.assert_array_equal(indices, [0, 2])
+
+
+def test_spatial_filter_complex_aoi(tmp_path) -> None:
+    # An AOI with enough coordinates for points to be resolved via a grid lookup
+    aoi = (
+        shapely.Point(10, 0)
+        .buffer(5, quad_segs=1_000)
+        .difference(shapely.box(9, -1, 11, 1))
+    )
+    assert shapely.get_num_coordinates(aoi) >= AOI_GRID_MIN_COORDINATES
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(4, 16, 100_000)
+    lats = rng.uniform(-6, 6, 100_000)
+    # Include points on the AOI's boundary
+    lons[:2], lats[:2] = [9, 15], [0, 0]
+    shapely.prepare(aoi)
+
+    with h5py.File(tmp_path / "beam.h5", "w") as hdf5:
+        hdf5.create_dataset("BEAM0000/lat_lowestmode", data=lats)
+        hdf5.create_dataset("BEAM0000/lon_lowestmode", data=lons)
+        aoi_grid = make_aoi_grid(aoi)
+        indices = spatial_filter(hdf5["BEAM0000"], aoi, aoi_grid=aoi_grid)
+
+    assert aoi_grid is not None
+    np.testing.assert_array_equal(
+        indices, np.flatnonzero(shapely.intersects_xy(aoi, lons, lats))
+    )
+    assert indices[:2].tolist() == [0, 1]
+
+
+def test_make_aoi_grid_simple_aoi(aoi_gdf: gpd.GeoDataFrame) -> None:
+    assert make_aoi_grid(aoi_gdf.unary_union) is None
+
+
 @pytest.mark.parametrize(
     "lat, lon, beams, columns, query, n_expected_rows",
     [
@@ -174,6 +275,7 @@ def fixture_path(filename: str) -> str:
         ),
     ],
 )
+@pytest.mark.parametrize("empty_beam", [False, True])
 def test_subset_hdf5(
     h5_path: str,
     aoi_gdf: gpd.GeoDataFrame,
@@ -183,7 +285,23 @@ def test_subset_hdf5(
     columns: Set[str],
     query: Optional[str],
     n_expected_rows: int,
+    empty_beam: bool,
 ) -> None:
+    if empty_beam:
+        # Add a coverage BEAM with the same datasets as BEAM0000, but no rows
+        with h5py.File(h5_path, "a") as hdf5:
+            source = hdf5["BEAM0000"]
+            target = hdf5.create_group("BEAM0010")
+            target.attrs.update(source.attrs)
+
+            def copy_empty(name: str, obj: Any) -> None:
+                if isinstance(obj, h5py.Dataset):
+                    target.create_dataset(
+                        name, shape=(0, *obj.shape[1:]), dtype=obj.dtype
+                    )
+
+            source.visititems(copy_empty)
+
     with h5py.File(h5_path) as hdf5:
         gdf = subset_hdf5(
             hdf5,
@@ -205,3 +323,142 @@ def test_subset_hdf5(
     # should first verify the correctness of our fixture data, otherwise we might spend
     # unnecessary time hunting down a non-existent bug.
     assert gdf.notna().all(axis=None)
+
+
+def test_subset_hdf5_no_matching_beams(h5_path: str, aoi_gdf: gpd.GeoDataFrame) -> None:
+    with h5py.File(h5_path) as hdf5:
+        gdf = subset_hdf5(
+            hdf5,
+            aoi=aoi_gdf,
+            lat="lat_lowestmode",
+            lon="lon_lowestmode",
+            beam_filter=beam_filter("0001"),
+            columns=["agbd"],
+            query=None,
+        )
+
+    assert gdf.empty
+    assert set(gdf.columns) == {"filename", "BEAM", "agbd", "geometry"}
+
+
+def test_subset_hdf5_invalid_query_outside_aoi(h5_path: str) -> None:
+    # No points fall within the AOI, but the query must still be checked
+    aoi = shapely.box(100, 50, 101, 51)
+
+    with h5py.File(h5_path) as hdf5, pytest.raises(SyntaxError):
+        subset_hdf5(
+            hdf5,
+            aoi=aoi,
+            lat="lat_lowestmode",
+            lon="lon_lowestmode",
+            columns=["agbd"],
+            query="sensitivity >",
+        )
+
+
+def test_subset_hdf5_max_workers(h5_path: str, aoi_gdf: gpd.GeoDataFrame) -> None:
+    def subset(max_workers: int) -> gpd.GeoDataFrame:
+        with h5py.File(h5_path) as hdf5:
+            return subset_hdf5(
+                hdf5,
+                aoi=aoi_gdf,
+                lat="lat_lowestmode",
+                lon="lon_lowestmode",
+                columns=["agbd", "sensitivity"],
+                query="sensitivity > 0.95",
+                max_workers=max_workers,
+            )
+
+    assert subset(2).equals(subset(1))
+
+
+def test_subset_hdf5_geometry_aoi(h5_path: str, aoi_gdf: gpd.GeoDataFrame) -> None:
+    def subset(aoi: Any) -> gpd.GeoDataFrame:
+        with h5py.File(h5_path) as hdf5:
+            return subset_hdf5(
+                hdf5,
+                aoi=aoi,
+                lat="lat_lowestmode",
+                lon="lon_lowestmode",
+                columns=["agbd", "sensitivity"],
+                query="sensitivity > 0.95",
+            )
+
+    assert subset(aoi_gdf.unary_union).equals(subset(aoi_gdf))
+
+
+def test_subset_hdf5_does_not_prepare_aoi(
+    h5_path: str, aoi_gdf: gpd.GeoDataFrame
+) -> None:
+    aoi = aoi_gdf.unary_union
+
+    with h5py.File(h5_path) as hdf5:
+        subset_hdf5(
+            hdf5,
+            aoi=aoi,
+            lat="lat_lowestmode",
+            lon="lon_lowestmode",
+            columns=["agbd"],
+            query=None,
+        )
+
+    assert not shapely.is_prepared(aoi)
+
+
+def test_subset_hdf5_duplicate_columns(h5_path: str, aoi_gdf: gpd.GeoDataFrame) -> None:
+    with h5py.File(h5_path) as hdf5:
+        gdf = subset_hdf5(
+            hdf5,
+            aoi=aoi_gdf,
+            lat="lat_lowestmode",
+            lon="lon_lowestmode",
+            columns=["sensitivity", "agbd", "sensitivity"],
+            query=None,
+        )
+
+    assert list(gdf.columns) == ["filename", "BEAM", "sensitivity", "agbd", "geometry"]
+
+
+@pytest.mark.parametrize(
+    "output_format, ext", [("parquet", ".parquet"), ("fgb", ".fgb")]
+)
+def test_write_subset(tmp_path, output_format: str, ext: str) -> None:
+    infile = str(tmp_path / "granule.h5")
+    gdf = gpd.GeoDataFrame(
+        {"agbd": [1.0, 2.0]}, geometry=shapely.points([10, 11], [0, 1]), crs=4326
+    )
+
+    outfile = write_subset(infile, gdf, output_format=output_format)
+
+    assert outfile == str(tmp_path / f"granule{ext}")
+    written = (
+        gpd.read_parquet(outfile)
+        if output_format == "parquet"
+        else gpd.read_file(outfile, engine="pyogrio")
+    )
+    # FlatGeobuf orders features by its spatial index, so restore the original order
+    written = written.sort_values("agbd", ignore_index=True)
+
+    assert written.agbd.tolist() == [1.0, 2.0]
+    assert written.geometry.geom_equals(gdf.geometry).all()
+
+
+def test_write_subset_default_format(tmp_path) -> None:
+    infile = str(tmp_path / "granule.h5")
+    gdf = gpd.GeoDataFrame(
+        {"agbd": [1.0]}, geometry=shapely.points([10], [0]), crs=4326
+    )
+
+    assert write_subset(infile, gdf) == str(tmp_path / "granule.fgb")
+
+
+def test_write_subset_unsupported_format(tmp_path) -> None:
+    infile = str(tmp_path / "granule.h5")
+    gdf = gpd.GeoDataFrame(
+        {"agbd": [1.0]}, geometry=shapely.points([10], [0]), crs=4326
+    )
+
+    with pytest.raises(ValueError, match="gpkg"):
+        write_subset(infile, gdf, output_format="gpkg")
+
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Iterable
+
+import h5py
+import numpy as np
+import pytest
+
+from gedi_subset.h5frame import H5DataFrame, _chunk_runs, read_rows
+
+N_ROWS = 100
+CHUNK_SIZE = 10
+
+
+@pytest.fixture
+def h5_group(tmp_path: Path) -> Iterable[h5py.Group]:
+    data = np.arange(N_ROWS, dtype="f4")
+
+    with h5py.File(tmp_path / "chunked.h5", "w") as h5:
+        group = h5.create_group("BEAM0000")
+        group.create_dataset(
+            "vector", data=data, chunks=(CHUNK_SIZE,), compression="gzip"
+        )
+        group.create_dataset(
+            "matrix",
+            data=np.stack([data * i for i in range(5)], axis=1),
+            chunks=(CHUNK_SIZE, 5),
+            compression="gzip",
+        )
+        group.create_dataset("flag", data=np.arange(N_ROWS) % 2, dtype="i1")
+        group.create_dataset(
+            "rh", data=np.arange(N_ROWS * 101, dtype="f4").reshape(N_ROWS, 101)
+        )
+
+        yield group
+
+
+@pytest.mark.parametrize(
+    "rows",
+    [
+        # Rows within a single chunk
+        [3, 4, 7],
+        # Rows within adjacent chunks
+        [8, 9, 10, 15],
+        # Rows separated by whole chunks containing no selected rows
+        [1, 2, 55, 97, 98],
+        # Contiguous rows spanning chunks
+        list(range(5, 35)),
+    ],
+)
+def test_read_rows_chunked(h5_group: h5py.Group, rows: list[int]):
+    selected = np.array(rows)
+    vector = h5_group["vector"]
+    matrix = h5_group["matrix"]
+
+    np.testing.assert_array_equal(read_rows(vector, selected), vector[()][selected])
+    np.testing.assert_array_equal(read_rows(matrix, selected), matrix[()][selected])
+    np.testing.assert_array_equal(
+        read_rows(matrix, selected, 3), matrix[()][selected, 3]
+    )
+
+
+def test_read_rows_all(h5_group: h5py.Group):
+    matrix = h5_group["matrix"]
+
+    np.testing.assert_array_equal(read_rows(matrix, None), matrix[()])
+    np.testing.assert_array_equal(read_rows(matrix, None, 2), matrix[()][:, 2])
+
+
+def test_read_rows_empty(h5_group: h5py.Group):
+    rows = np.array([], dtype=int)
+
+    assert read_rows(h5_group["vector"], rows).shape == (0,)
+    assert read_rows(h5_group["matrix"], rows).shape == (0, 5)
+    assert read_rows(h5_group["matrix"], rows, 1).shape == (0,)
+
+
+def test_chunk_runs():
+    runs = _chunk_runs(np.array([1, 2, 9, 10, 35, 36, 97]), CHUNK_SIZE)
+
+    assert [run.tolist() for run in runs] == [[1, 2, 9, 10], [35, 36], [97]]
+
+
+def test_h5dataframe_rows_query(h5_group: h5py.Group):
+    rows = np.array([2, 3, 4, 55, 56, 97])
+    df = H5DataFrame(h5_group, rows=rows).query("flag == 1")
+
+    # Only the selected rows are read, and the query then discards rows 2, 4, and
+    # 56, so columns read after the query are read only for the remaining rows.
+    assert df["flag"].tolist() == [1, 1, 1]
+    assert df["vector"].tolist() == [3.0, 55.0, 97.0]
+    assert df.columns.tolist() == ["flag", "vector"]
+
+
+def test_h5dataframe_2d_column(h5_group: h5py.Group):
+    rh = h5_group["rh"][()]
+    df = H5DataFrame(h5_group)
+
+    # Selecting a single column of a 2D dataset inserts only that column
+    np.testing.assert_array_equal(df["rh50"], rh[:, 50])
+    np.testing.assert_array_equal(df["rh98"], rh[:, 98])
+    assert df.columns.tolist() == ["rh50", "rh98"]
+
+
+def test_h5dataframe_2d_column_rows_query(h5_group: h5py.Group):
+    rows = np.array([2, 3, 4, 55, 56, 97])
+    rh = h5_group["rh"][()]
+    df = H5DataFrame(h5_group, rows=rows).query("flag == 1")
+
+    np.testing.assert_array_equal(df["rh50"], rh[[3, 55, 97], 50])
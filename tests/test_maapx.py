@@ -1,34 +1,28 @@
 import json
 import pathlib
 import re
-from typing import Any, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any
 
 import pytest
 import requests
 import responses
 from maap.maap import MAAP
-from maap.Result import Granule
 from mypy_boto3_s3.client import S3Client
 from returns.functions import raise_exception
+from returns.io import IOSuccess
 from returns.unsafe import unsafe_perform_io
 
-from gedi_subset.maapx import download_granule
+from gedi_subset.maapx import download_granule, find_collection
+
+from .conftest import make_granule
 
 EDC_CREDENTIALS_URL_PATTERN = re.compile(
     "https://.+/api/members/self/awsAccess/edcCredentials/.+"
 )
 
 
-def make_granule(metadata: Mapping[str, Any]) -> Granule:
-    return Granule(
-        metadata,
-        awsAccessKey="",
-        awsAccessSecret="",
-        apiHeader={},
-        cmrFileUrl="",
-    )
-
-
 def test_download_granule_no_s3credentials(
     maap: MAAP,
     s3: S3Client,
@@ -165,3 +159,148 @@ def test_download_granule_https_failure(
         with responses.RequestsMock() as mock:
             mock.get(url="https://host/file.txt", status=404)
             download_granule(maap, str(tmp_path), granule).alt(raise_exception)
+
+
+def test_find_collection_caches_search(maap: MAAP, monkeypatch: pytest.MonkeyPatch):
+    searches = []
+
+    def search_collection(**params: Any):
+        searches.append(params)
+        return [{"Collection": {"ShortName": "GEDI02_A"}}]
+
+    monkeypatch.setattr(maap, "searchCollection", search_collection, raising=False)
+
+    first = find_collection(maap, "cmr.host", {"doi": "mydoi"})
+    second = find_collection(maap, "cmr.host", {"doi": "mydoi"})
+
+    assert first == second == IOSuccess({"Collection": {"ShortName": "GEDI02_A"}})
+    assert searches == [{"cmr_host": "cmr.host", "limit": 1, "doi": "mydoi"}]
+
+
+def test_find_collection_not_found(maap: MAAP, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(maap, "searchCollection", lambda **_: [], raising=False)
+
+    with pytest.raises(ValueError, match="No collection found"):
+        find_collection(maap, "cmr.host", {"doi": "nodoi"}).alt(raise_exception)
+
+
+def test_download_granule_s3credentials_http_fallback(
+    maap: MAAP,
+    s3: S3Client,
+    tmp_path: pathlib.Path,
+):
+    s3.create_bucket(Bucket="mybucket")
+
+    creds = {
+        "sessionToken": "mytoken",
+        "accessKeyId": "mykeyid",
+        "secretAccessKey": "myaccesskey",
+    }
+    granule = make_granule(
+        {
+            "Granule": {
+                "GranuleUR": "foo",
+                "OnlineAccessURLs": {
+                    "OnlineAccessURL": [
+                        {"URL": "s3://mybucket/file.txt"},
+                        {"URL": "https://host/file.txt"},
+                    ]
+                },
+                "OnlineResources": {
+                    "OnlineResource": {"URL": "https://host/s3credentials"}
+                },
+            }
+        }
+    )
+
+    # The object is missing from S3 (as though S3 access were denied), so the
+    # granule is downloaded via HTTPS instead.
+    with responses.RequestsMock() as mock:
+        mock.get(url=EDC_CREDENTIALS_URL_PATTERN, status=200, body=json.dumps(creds))
+        mock.get(url="https://host/file.txt", status=200, body="https contents")
+        filename = unsafe_perform_io(
+            download_granule(maap, str(tmp_path), granule).unwrap()
+        )
+
+    with open(filename) as f:
+        assert f.read() == "https contents"
+
+
+def test_download_granule_s3credentials_concurrent(
+    maap: MAAP,
+    s3: S3Client,
+    tmp_path: pathlib.Path,
+):
+    s3.create_bucket(Bucket="mybucket")
+    keys = [f"file{i}.txt" for i in range(8)]
+
+    for key in keys:
+        s3.put_object(Bucket="mybucket", Key=key, Body=f"{key} contents")
+
+    creds = {
+        "sessionToken": "mytoken",
+        "accessKeyId": "mykeyid",
+        "secretAccessKey": "myaccesskey",
+    }
+    granules = [
+        make_granule(
+            {
+                "Granule": {
+                    "GranuleUR": key,
+                    "OnlineAccessURLs": {
+                        "OnlineAccessURL": {"URL": f"s3://mybucket/{key}"}
+                    },
+                    "OnlineResources": {
+                        "OnlineResource": {"URL": "https://host/s3credentials"}
+                    },
+                }
+            }
+        )
+        for key in keys
+    ]
+
+    with responses.RequestsMock() as mock:
+        mock.get(url=EDC_CREDENTIALS_URL_PATTERN, status=200, body=json.dumps(creds))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(
+                executor.map(partial(download_granule, maap, str(tmp_path)), granules)
+            )
+
+        # Credentials are obtained only once, by the first thread to need them.
+        assert len(mock.calls) == 1
+
+    for key, result in zip(keys, results):
+        with open(unsafe_perform_io(result.unwrap())) as f:
+            assert f.read() == f"{key} contents"
+
+
+def test_download_granule_no_s3credentials_http_fallback(
+    maap: MAAP,
+    s3: S3Client,
+    tmp_path: pathlib.Path,
+):
+    s3.create_bucket(Bucket="mybucket")
+
+    granule = make_granule(
+        {
+            "Granule": {
+                "GranuleUR": "foo",
+                "OnlineAccessURLs": {
+                    "OnlineAccessURL": [
+                        {"URL": "s3://mybucket/file.txt"},
+                        {"URL": "https://host/file.txt"},
+                    ]
+                },
+            }
+        }
+    )
+
+    with responses.RequestsMock() as mock:
+        mock.get(url="https://host/file.txt", status=200, body="https contents")
+        filename = unsafe_perform_io(
+            download_granule(maap, str(tmp_path), granule).unwrap()
+        )
+
+    with open(filename) as f:
+        assert f.read() == "https contents"
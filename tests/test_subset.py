@@ -1,21 +1,91 @@
+import json
+import logging
 import os
+import shutil
+import threading
+import time
 from pathlib import Path
+from typing import Callable, Sequence
 
 import geopandas as gpd
+import pyarrow.parquet as pq
 import pytest
 from maap.maap import MAAP
 from maap.Result import Granule
-from returns.io import IOSuccess
+from returns.functions import raise_exception
+from returns.io import IOFailure, IOResultE, IOSuccess, impure_safe
 from returns.maybe import Some
+from returns.unsafe import unsafe_perform_io
 from typer import BadParameter
 
-from gedi_subset.subset import SubsetGranuleProps, check_beams_option, subset_granule
+import gedi_subset.subset
+from gedi_subset.subset import (
+    PARQUET_ROW_GROUP_SIZE,
+    OutputFormat,
+    SubsetGranuleProps,
+    _available_cpu_count,
+    aoi_geometry,
+    check_beams_option,
+    subset_granule,
+    subset_granules,
+)
+
+from .conftest import make_granule
+
+
+def make_granules(names: Sequence[str]) -> Sequence[Granule]:
+    return [
+        make_granule(
+            {
+                "Granule": {
+                    "GranuleUR": name,
+                    "OnlineAccessURLs": {
+                        "OnlineAccessURL": {"URL": f"s3://mybucket/{name}.h5"}
+                    },
+                }
+            }
+        )
+        for name in names
+    ]
+
+
+DownloadGranule = Callable[[MAAP, str, Granule], IOResultE[str]]
+
+
+@pytest.fixture
+def stub_download(monkeypatch: pytest.MonkeyPatch, h5_path: str) -> DownloadGranule:
+    """Stub granule downloads with copies of the h5 fixture file, failing to
+    "download" any granule named "bad", and return the stub."""
+
+    def download_granule(maap: MAAP, todir: str, granule: Granule) -> IOResultE[str]:
+        name = granule["Granule"]["GranuleUR"]
+
+        if name == "bad":
+            return IOFailure(RuntimeError(f"failed to download {name}"))
+
+        return impure_safe(shutil.copy)(h5_path, os.path.join(todir, f"{name}.h5"))
+
+    monkeypatch.setattr(gedi_subset.subset, "download_granule", download_granule)
+
+    return download_granule
+
+
+def test_aoi_geometry_reprojects(aoi_gdf: gpd.GeoDataFrame):
+    aoi = aoi_gdf.set_crs(epsg=4326)
+    projected = aoi.to_crs(epsg=3857)
+
+    assert aoi_geometry(projected).equals_exact(aoi.unary_union, 1e-9)
+
+
+def test_aoi_geometry_without_crs(aoi_gdf: gpd.GeoDataFrame):
+    assert aoi_gdf.crs is None
+    assert aoi_geometry(aoi_gdf).equals(aoi_gdf.unary_union)
 
 
 def test_subset_granule(maap: MAAP, h5_path: str, aoi_gdf: gpd.GeoDataFrame):
     output_dir = os.path.dirname(h5_path)
     filename = os.path.basename(h5_path)
-    granule = Granule(
+    granule = make_granule(
         {
             "Granule": {
                 "GranuleUR": "foo",
@@ -23,11 +93,7 @@ def test_subset_granule(maap: MAAP, h5_path: str, aoi_gdf: gpd.GeoDataFrame):
                     "OnlineAccessURL": {"URL": f"s3://mybucket/{filename}"}
                 },
             }
-        },
-        awsAccessKey="",
-        awsAccessSecret="",
-        apiHeader={},
-        cmrFileUrl="",
+        }
     )
 
     # Since we have used a fixture to generate an h5 file, when subset_granule attempts
@@ -55,6 +121,166 @@ def test_subset_granule(maap: MAAP, h5_path: str, aoi_gdf: gpd.GeoDataFrame):
     assert io_result == IOSuccess(Some(expected_path))
 
 
+@pytest.mark.parametrize("output_format", list(OutputFormat))
+@pytest.mark.parametrize("row_group_size", [1, PARQUET_ROW_GROUP_SIZE])
+def test_subset_granules(
+    maap: MAAP,
+    aoi_gdf: gpd.GeoDataFrame,
+    stub_download: DownloadGranule,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    output_format: OutputFormat,
+    row_group_size: int,
+):
+    # Combine the subsets in tables of 1 row, as well as all in one table
+    monkeypatch.setattr(gedi_subset.subset, "PARQUET_ROW_GROUP_SIZE", row_group_size)
+    dest = tmp_path / f"gedi_subset.{output_format}"
+    granules = make_granules(["g1", "g2", "g3"])
+
+    result = subset_granules(
+        maap,
+        aoi_gdf.unary_union,
+        "lat_lowestmode",
+        "lon_lowestmode",
+        "all",
+        ["agbd"],
+        "l2_quality_flag == 1",
+        tmp_path,
+        dest,
+        (logging.INFO,),
+        granules,
+    )
+
+    # The subsets are combined into the destination file, and then removed, along
+    # with the downloaded granule files.
+    assert len(unsafe_perform_io(result.unwrap())) == len(granules)
+    assert os.listdir(tmp_path) == [dest.name]
+
+    gdf = (
+        gpd.read_parquet(dest)
+        if output_format == OutputFormat.parquet
+        else gpd.read_file(dest, engine="pyogrio")
+    )
+
+    # Each granule contributes the 2 rows (1 per beam) within the AOI and with
+    # l2_quality_flag == 1.
+    assert len(gdf) == 2 * len(granules)
+    assert sorted(gdf.columns) == ["BEAM", "agbd", "filename", "geometry"]
+    assert sorted(gdf.filename.unique()) == ["g1.h5", "g2.h5", "g3.h5"]
+
+
+def test_subset_granules_parquet_metadata(
+    maap: MAAP,
+    aoi_gdf: gpd.GeoDataFrame,
+    stub_download: DownloadGranule,
+    tmp_path: Path,
+):
+    dest = tmp_path / "gedi_subset.parquet"
+
+    subset_granules(
+        maap,
+        aoi_gdf.unary_union,
+        "lat_lowestmode",
+        "lon_lowestmode",
+        "all",
+        ["agbd"],
+        None,
+        tmp_path,
+        dest,
+        (logging.INFO,),
+        make_granules(["g1", "g2"]),
+    ).alt(raise_exception)
+
+    geo = json.loads(pq.read_schema(dest).metadata[b"geo"])
+    geometry_meta = geo["columns"][geo["primary_column"]]
+
+    # The bbox of each subset (which would be that of only the first subset in the
+    # combined file) is dropped, but the rest of the metadata is retained.
+    assert "bbox" not in geometry_meta
+    assert geometry_meta["encoding"] == "WKB"
+    assert geometry_meta["geometry_types"] == ["Point"]
+
+
+def test_subset_granules_download_failure(
+    maap: MAAP,
+    aoi_gdf: gpd.GeoDataFrame,
+    stub_download: DownloadGranule,
+    tmp_path: Path,
+):
+    dest = tmp_path / "gedi_subset.gpkg"
+
+    with pytest.raises(RuntimeError, match="failed to download bad"):
+        subset_granules(
+            maap,
+            aoi_gdf.unary_union,
+            "lat_lowestmode",
+            "lon_lowestmode",
+            "all",
+            ["agbd"],
+            None,
+            tmp_path,
+            dest,
+            (logging.INFO,),
+            make_granules(["g1", "bad", "g3"]),
+        ).alt(raise_exception)
+
+    assert not dest.exists()
+
+
+def test_subset_granules_download_failure_in_flight(
+    maap: MAAP,
+    aoi_gdf: gpd.GeoDataFrame,
+    stub_download: DownloadGranule,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    # Download both granules concurrently, where the "slow" download is still in
+    # progress when the "bad" download fails.
+    monkeypatch.setattr(gedi_subset.subset, "_available_cpu_count", lambda: 2)
+    release = threading.Event()
+
+    def slow_download_granule(maap: MAAP, todir: str, granule: Granule):
+        if granule["Granule"]["GranuleUR"] == "slow":
+            release.wait(10)
+
+        return stub_download(maap, todir, granule)
+
+    monkeypatch.setattr(gedi_subset.subset, "download_granule", slow_download_granule)
+    start = time.monotonic()
+
+    result = subset_granules(
+        maap,
+        aoi_gdf.unary_union,
+        "lat_lowestmode",
+        "lon_lowestmode",
+        "all",
+        ["agbd"],
+        None,
+        tmp_path,
+        tmp_path / "gedi_subset.gpkg",
+        (logging.INFO,),
+        make_granules(["slow", "bad"]),
+    )
+
+    # The failure is reported without waiting for the download in progress, ...
+    assert time.monotonic() - start < 5
+    assert isinstance(result, IOFailure)
+
+    # ... which is removed as soon as it completes.
+    release.set()
+
+    for _ in range(100):
+        if not os.listdir(tmp_path):
+            break
+        time.sleep(0.05)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_available_cpu_count():
+    assert 1 <= _available_cpu_count() <= (os.cpu_count() or 1)
+
+
 @pytest.mark.parametrize(
     "value",
     [